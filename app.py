@@ -1,15 +1,21 @@
-from flask import Flask, jsonify, request
+from flask import Flask, request, stream_with_context
 from flask_cors import CORS
 from PIL import Image
-from paddleocr import PaddleOCR
 import io
 import os
-import json
+import orjson
 import base64
 import re
+import threading
+import multiprocessing
 import numpy as np
+import cv2
+import httpx
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from functools import lru_cache
 from dotenv import load_dotenv
-from groq import Groq
+from groq import DefaultHttpxClient, Groq
 from werkzeug.utils import secure_filename
 
 # Load environment variables
@@ -18,27 +24,64 @@ load_dotenv()
 app = Flask(__name__)
 CORS(app, resources={r"/api/*": {"origins": "*"}}) # Allow all origins for dev
 
-# Initialize PaddleOCR with simple configuration
-# Using CPU mode and basic OCR (no document preprocessing)
-ocr = PaddleOCR(
-    use_angle_cls=True,
-    lang='en',
-    use_gpu=False,
-    show_log=False,
-    enable_mkldnn=False,
-    use_tensorrt=False
-)
+def json_response(payload, status=200):
+    """Serialize a payload with orjson (bytes straight into the response body)"""
+    return app.response_class(orjson.dumps(payload), status=status, mimetype='application/json')
 
-# Initialize Groq client
-groq_client = Groq(api_key=os.getenv("GROQ_API_KEY"))
+# Initialize Groq client. DefaultHttpxClient keeps the SDK's client defaults;
+# only the connection cap (SDK default 1000/100 keep-alive) and the timeout
+# (SDK default 60s) are lowered. With the SDK's 2 retries, a stalled call is
+# bounded at about 90s.
+groq_client = Groq(
+    api_key=os.getenv("GROQ_API_KEY"),
+    http_client=DefaultHttpxClient(
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=32),
+        timeout=httpx.Timeout(30.0, connect=5.0)
+    )
+)
 
 # Configuration
 AI_PARSING_ENABLED = os.getenv("AI_PARSING_ENABLED", "true").lower() == "true"
 GROQ_MODEL = os.getenv("GROQ_MODEL", "llama-3.3-70b-versatile")
 MIN_OCR_CONFIDENCE = float(os.getenv("MIN_OCR_CONFIDENCE", "0.35"))  # Minimum 35% confidence
+MIN_RECEIPT_TEXT_LENGTH = 40  # Shorter OCR text is not sent to the AI
+MIN_RECEIPT_DIGITS = 3  # A receipt has at least a price; fewer digits means no useful text
+OCR_WORKERS = int(os.getenv("OCR_WORKERS", str(os.cpu_count() or 1)))  # Parallel OCR processes
+OCR_PREPROCESSING_ENABLED = os.getenv("OCR_PREPROCESSING_ENABLED", "false").lower() == "true"
+GROQ_CACHE_SIZE = 512  # Groq responses kept per process, keyed by the prompt text
+# JPEGs are decoded at 1/2, 1/4 or 1/8 scale only while both sides stay at least
+# this large, e.g. a 4032x3024 (12 MP) photo decodes at 2016x1512. That is still
+# above PaddleOCR's 960 px detection limit, with headroom for recognition crops.
+OCR_DRAFT_SIZE = (1500, 1500)
+MAX_UPLOAD_MB = int(os.getenv("MAX_UPLOAD_MB", "10"))  # Larger request bodies are rejected with 413
+MAX_IMAGE_PIXELS = 50_000_000  # Larger images are rejected before decoding (decompression bomb guard)
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+IMAGE_TOO_LARGE_ERROR = f'Image too large. Maximum size is {MAX_IMAGE_PIXELS // 1_000_000} megapixels'
+
+# Accepted upload extensions (AI endpoints), in the order listed in error messages
+ALLOWED_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.gif', '.bmp', '.webp')
+INVALID_FILE_TYPE_ERROR = f'Invalid file type. Allowed: {", ".join(ext[1:] for ext in ALLOWED_EXTENSIONS)}'
+
+# File signatures of the accepted image formats, checked instead of trusting the extension
+IMAGE_SIGNATURES = (
+    b'\x89PNG\r\n\x1a\n',  # PNG
+    b'\xff\xd8\xff',  # JPEG
+    b'GIF87a',
+    b'GIF89a',
+    b'BM',  # BMP
+)
+
+def has_image_signature(image_bytes):
+    """Check the magic bytes of an upload against the supported image formats"""
+    header = image_bytes[:12]
+    if header[:4] == b'RIFF' and header[8:12] == b'WEBP':
+        return True
+    return header.startswith(IMAGE_SIGNATURES)
 
 # Supported categories - frontend will map these to UUIDs
-CATEGORIES = [
+CATEGORIES_LIST = [
     "Groceries",
     "Dining",
     "Transport",
@@ -48,6 +91,166 @@ CATEGORIES = [
     "Utilities",
     "Uncategorized"
 ]
+CATEGORIES = frozenset(CATEGORIES_LIST)  # Membership checks on LLM output
+
+def normalize_category(category):
+    """Return the category if it is supported, else 'Uncategorized'"""
+    return category if isinstance(category, str) and category in CATEGORIES else 'Uncategorized'
+
+# Groq prompts; only the OCR text / item list appended to the user prompt varies
+_CATEGORY_LIST = ", ".join(CATEGORIES_LIST)
+
+_PARSE_SYSTEM_PROMPT = f"""Receipt parser. Extract data from OCR text. Categories: {_CATEGORY_LIST}
+
+Rules: Extract readable info only. No fabrication. Use null if unclear. Return {{"error":"unreadable"}} only if complete gibberish."""
+
+_PARSE_USER_PROMPT = """Parse to JSON:
+- store: name or null
+- date: YYYY-MM-DD or null
+- total: amount or null (if missing or 0, sum item totals)
+- tax: amount or null
+- items: [{description, quantity (default 1), unitPrice (calc if needed: total/qty), total, category}]
+
+Price formats: $1.99, 1.99, 1,99. Examples: "2 x $3.50 = $7.00" → qty=2, unit=3.50, total=7.00 | "Milk $4.99" → qty=1, unit=4.99, total=4.99
+
+Text:
+"""
+
+_CATEGORIZE_SYSTEM_PROMPT = f"""You are a receipt item categorizer. Categorize each item into one of these categories: {_CATEGORY_LIST}
+
+Return JSON with category names in the same order as the input items. Example: {{"categories": ["Groceries", "Dining", "Transport"]}}"""
+
+_CATEGORIZE_USER_PROMPT = """Categorize these items:
+"""
+
+# Receipt line patterns used by the regex parser
+_PRICE_RE = re.compile(r'\d+\.\d{2}')
+_QTY_RE = re.compile(r'(\d+)\s*x\s*(.*)', re.IGNORECASE)
+_KEYWORD_RE = re.compile(r'\b(subtotal|total|tax|balance|change|cash|card)\b', re.IGNORECASE)
+# One pass over the whole OCR text: each alternative matches a full line, tried
+# in priority order (total/subtotal, tax, date, item); dispatch on lastgroup
+# ([^\S\n] is any whitespace except newline, matching str.strip() per line)
+_SCAN_RE = re.compile(
+    r'^[^\S\n]*(?:'
+    r'(?P<total>[^\n]*total[^\n]*?)'
+    r'|(?P<tax>[^\n]*tax[^\n]*?)'
+    r'|(?P<date>[^\n]*\d{1,2}[/-]\d{1,2}[/-]\d{2,4}[^\n]*?)'
+    r'|(?P<item>(?P<description>[^\n]*?)[^\S\n]*\$?[^\S\n]*(?P<price>\d+[.,]\d{2}))'
+    r')[^\S\n]*$',
+    re.IGNORECASE | re.MULTILINE
+)
+
+# Common receipt words per category, used to categorize regex-extracted items
+# locally. Words that commonly belong to several categories (coffee, water, gas,
+# oil, phone, ...) are left out; items with no known word, or with words from
+# different categories, are sent to the AI categorizer
+CATEGORY_KEYWORDS = {
+    "Groceries": {
+        "milk", "bread", "eggs", "egg", "butter", "cheese", "yogurt", "cream",
+        "apple", "apples", "banana", "bananas", "orange", "oranges", "tomato",
+        "tomatoes", "potato", "potatoes", "onion", "onions", "lettuce", "carrot",
+        "carrots", "rice", "pasta", "flour", "sugar", "salt", "cereal",
+        "beef", "pork", "meat", "juice", "produce", "grocery",
+        "vegetables", "fruit"
+    },
+    "Dining": {
+        "burger", "pizza", "sandwich", "fries", "latte", "cappuccino", "espresso",
+        "meal", "combo", "entree", "appetizer", "dessert", "tip", "gratuity",
+        "restaurant", "cafe", "dine", "takeout", "taco", "tacos", "burrito",
+        "nachos", "wings", "sushi", "omelette", "pancakes", "benedict"
+    },
+    "Transport": {
+        "fuel", "gasoline", "diesel", "petrol", "parking", "toll", "taxi",
+        "uber", "lyft", "bus", "train", "metro", "subway", "fare"
+    },
+    "Entertainment": {
+        "movie", "cinema", "concert", "netflix", "spotify",
+        "theater", "theatre", "admission", "popcorn"
+    },
+    "Shopping": {
+        "shirt", "pants", "jeans", "shoes", "dress", "jacket", "socks", "clothing",
+        "electronics", "charger", "cable", "toy", "toys", "book", "books", "gift"
+    },
+    "Health": {
+        "pharmacy", "medicine", "vitamin", "vitamins", "aspirin", "ibuprofen",
+        "bandage", "bandages", "prescription", "rx", "toothpaste", "shampoo",
+        "soap", "sanitizer"
+    },
+    "Utilities": {
+        "electricity", "electric", "internet", "utility", "sewer", "trash"
+    }
+}
+_KEYWORD_CATEGORIES = {
+    word: category
+    for category, words in CATEGORY_KEYWORDS.items()
+    for word in words
+}
+_WORD_RE = re.compile(r'[a-z]+')
+
+def classify_item(description):
+    """Return the category when all known keywords in a description agree, else None"""
+    categories = {
+        _KEYWORD_CATEGORIES[word]
+        for word in _WORD_RE.findall(description.lower())
+        if word in _KEYWORD_CATEGORIES
+    }
+    return categories.pop() if len(categories) == 1 else None
+
+# PaddleOCR instance of the current OCR worker process (see _init_ocr_worker)
+ocr = None
+
+def _init_ocr_worker():
+    """Load the PaddleOCR models once per OCR worker process"""
+    # Imported here so web processes don't load the Paddle framework
+    from paddleocr import PaddleOCR
+    
+    global ocr
+    # Using CPU mode and basic OCR (no document preprocessing).
+    # PaddleOCR 2.x options; the Dockerfile model download uses the same ones.
+    ocr = PaddleOCR(
+        use_angle_cls=True,
+        lang='en',
+        use_gpu=False,
+        show_log=False,
+        enable_mkldnn=False,
+        use_tensorrt=False
+    )
+
+def _create_ocr_pool():
+    """Start a pool of OCR worker processes.
+    
+    Workers come from a forkserver rather than being forked from a request
+    thread of the (multi-threaded) web server, which could copy held locks.
+    """
+    return ProcessPoolExecutor(
+        max_workers=OCR_WORKERS,
+        initializer=_init_ocr_worker,
+        mp_context=multiprocessing.get_context("forkserver")
+    )
+
+# OCR is CPU-bound, so it runs in a bounded pool of processes instead of on
+# the request threads. Each worker keeps its own persistent PaddleOCR instance.
+# The pool is created on first use: OCR workers import this module too, and
+# must not start pools of their own.
+ocr_pool = None
+ocr_pool_lock = threading.Lock()
+
+def _get_ocr_pool():
+    """Return the OCR pool, creating it on first use"""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is None:
+            ocr_pool = _create_ocr_pool()
+        return ocr_pool
+
+def _replace_broken_ocr_pool(broken_pool):
+    """Swap a broken OCR pool for a fresh one (once, however many threads noticed)"""
+    global ocr_pool
+    with ocr_pool_lock:
+        if ocr_pool is broken_pool:
+            broken_pool.shutdown(wait=False, cancel_futures=True)
+            ocr_pool = _create_ocr_pool()
+        return ocr_pool
 
 def perform_ocr_with_paddleocr(image):
     """Perform OCR using PaddleOCR and return text, confidence, and bounding boxes"""
@@ -60,84 +263,166 @@ def perform_ocr_with_paddleocr(image):
     if not result or not result[0]:
         return "", 0.3, []
     
-    # Extract text, confidence scores, and bounding boxes
-    full_text_lines = []
-    confidences = []
-    ocr_data = []
+    lines = result[0]
     
-    for line in result[0]:
-        box, (text, confidence) = line
-        full_text_lines.append(text)
-        confidences.append(confidence)
-        
-        # Store detailed OCR data with bounding boxes
-        ocr_data.append({
+    # Extract text, confidence scores, and bounding boxes (corners truncated to ints)
+    texts = [text for _, (text, _) in lines]
+    confidences = np.fromiter((confidence for _, (_, confidence) in lines), dtype=np.float64, count=len(lines))
+    boxes = np.asarray([box for box, _ in lines], dtype=np.float64).astype(np.int64).tolist()
+    
+    # Store detailed OCR data with bounding boxes
+    ocr_data = [
+        {
             'text': text,
             'confidence': round(confidence, 3),
             'bounding_box': {
-                'top_left': [int(box[0][0]), int(box[0][1])],
-                'top_right': [int(box[1][0]), int(box[1][1])],
-                'bottom_right': [int(box[2][0]), int(box[2][1])],
-                'bottom_left': [int(box[3][0]), int(box[3][1])]
+                'top_left': box[0],
+                'top_right': box[1],
+                'bottom_right': box[2],
+                'bottom_left': box[3]
             }
-        })
+        }
+        for text, confidence, box in zip(texts, confidences.tolist(), boxes)
+    ]
     
-    # Calculate average confidence
-    avg_confidence = sum(confidences) / len(confidences) if confidences else 0.3
+    # Calculate average confidence over regions that contain text
+    has_text = np.fromiter((bool(text.strip()) for text in texts), dtype=bool, count=len(texts))
+    scored = confidences[has_text]
+    avg_confidence = float(scored.mean()) if scored.size else 0.3
     
     # Join all text lines
-    full_text = '\n'.join(full_text_lines)
+    full_text = '\n'.join(texts)
     
     return full_text, round(avg_confidence, 3), ocr_data
 
-def parse_receipt_with_ai(image):
-    """Parse receipt using OCR + OpenAI text parsing"""
-    # Step 1: OCR the image to get raw text, confidence, and bounding boxes
-    raw_text, ocr_confidence, ocr_data = perform_ocr_with_paddleocr(image)
+def preprocess_for_ocr(image):
+    """Grayscale, binarize (Otsu), denoise, and deskew an image before OCR.
     
-    # Check if OCR confidence is too low
-    if ocr_confidence < MIN_OCR_CONFIDENCE:
-        raise ValueError(f"OCR confidence too low ({ocr_confidence:.0%}). Image quality insufficient for reliable parsing. Minimum required: {MIN_OCR_CONFIDENCE:.0%}")
+    Returns the cleaned PIL image and the 2x3 affine matrix used for deskewing
+    (None when the image was not rotated). Off by default: PaddleOCR does its own
+    normalization, and the deskew estimate assumes a light background (a dark
+    table around the receipt dominates minAreaRect).
+    """
+    gray = np.asarray(image if image.mode == 'L' else image.convert('L'))
+    _, binary = cv2.threshold(gray, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    binary = cv2.medianBlur(binary, 3)
     
-    # Build category list for the prompt
-    category_list = ", ".join(CATEGORIES)
+    # Estimate skew from the minimum-area rectangle around the dark (text) pixels
+    coords = cv2.findNonZero(cv2.bitwise_not(binary))
+    if coords is None:
+        return Image.fromarray(binary), None
+    angle = cv2.minAreaRect(coords)[-1]
+    # Normalize to [-45, 45]; works for both OpenCV angle conventions
+    if angle > 45:
+        angle -= 90
+    elif angle < -45:
+        angle += 90
+    if abs(angle) < 0.5:
+        return Image.fromarray(binary), None
     
-    # Step 2: Use Groq to parse the OCR text
+    height, width = binary.shape
+    matrix = cv2.getRotationMatrix2D((width / 2, height / 2), angle, 1.0)
+    deskewed = cv2.warpAffine(
+        binary, matrix, (width, height),
+        flags=cv2.INTER_CUBIC, borderMode=cv2.BORDER_REPLICATE
+    )
+    return Image.fromarray(deskewed), matrix
+
+def transform_bounding_boxes(ocr_data, matrix):
+    """Apply a 2x3 affine matrix to every bounding box corner in place"""
+    for entry in ocr_data:
+        box = entry['bounding_box']
+        for corner, (x, y) in box.items():
+            box[corner] = [
+                int(round(matrix[0][0] * x + matrix[0][1] * y + matrix[0][2])),
+                int(round(matrix[1][0] * x + matrix[1][1] * y + matrix[1][2]))
+            ]
+    return ocr_data
+
+def ocr_image_bytes(image_bytes):
+    """Decode an uploaded image and OCR it (runs inside an OCR worker process)"""
+    image = Image.open(io.BytesIO(image_bytes))
+    original_width, original_height = image.size
+    
+    # PIL itself only raises above 2x MAX_IMAGE_PIXELS, so enforce the limit here
+    if original_width * original_height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(IMAGE_TOO_LARGE_ERROR)
+    
+    # Lazy decode: for large JPEGs, let libjpeg decode at a reduced DCT scale
+    # instead of decoding the full image (keeps the image's own mode)
+    image.draft(image.mode, OCR_DRAFT_SIZE)
+    width, height = image.size
+    
+    # PaddleOCR expects 3-channel input; normalize palette, alpha, and CMYK uploads
+    if image.mode != 'RGB':
+        image = image.convert('RGB')
+    
+    deskew_matrix = None
+    if OCR_PREPROCESSING_ENABLED:
+        image, deskew_matrix = preprocess_for_ocr(image)
+    
+    raw_text, ocr_confidence, ocr_data = perform_ocr_with_paddleocr(image)
+    
+    # Keep bounding boxes in the coordinates of the uploaded image
+    if deskew_matrix is not None:
+        transform_bounding_boxes(ocr_data, cv2.invertAffineTransform(deskew_matrix))
+    if (width, height) != (original_width, original_height):
+        transform_bounding_boxes(ocr_data, [
+            [original_width / width, 0, 0],
+            [0, original_height / height, 0]
+        ])
+    
+    return raw_text, ocr_confidence, ocr_data
+
+def run_ocr(image_bytes):
+    """Submit an image to the OCR pool and wait for text, confidence, and bounding boxes"""
+    pool = _get_ocr_pool()
+    try:
+        return pool.submit(ocr_image_bytes, image_bytes).result()
+    except BrokenProcessPool:
+        # A worker died (e.g. OOM-killed) or failed to load its models; the
+        # executor stays broken forever, so retry once on a fresh pool
+        pool = _replace_broken_ocr_pool(pool)
+        return pool.submit(ocr_image_bytes, image_bytes).result()
+
+@lru_cache(maxsize=GROQ_CACHE_SIZE)
+def groq_parse_receipt_text(raw_text):
+    """Ask Groq to parse OCR text into receipt JSON and return the raw reply"""
     response = groq_client.chat.completions.create(
         model=GROQ_MODEL,
         messages=[
-            {
-                "role": "system",
-                "content": f"""Receipt parser. Extract data from OCR text. Categories: {category_list}
-
-Rules: Extract readable info only. No fabrication. Use null if unclear. Return {{"error":"unreadable"}} only if complete gibberish. Output JSON only."""
-            },
-            {
-                "role": "user",
-                "content": f"""Parse to JSON:
-- store: name or null
-- date: YYYY-MM-DD or null
-- total: amount or null (if missing or 0, sum item totals)
-- tax: amount or null
-- items: [{{description, quantity (default 1), unitPrice (calc if needed: total/qty), total, category}}]
-
-Price formats: $1.99, 1.99, 1,99. Examples: "2 x $3.50 = $7.00" → qty=2, unit=3.50, total=7.00 | "Milk $4.99" → qty=1, unit=4.99, total=4.99
-
-Text:
-{raw_text}"""
-            }
+            {"role": "system", "content": _PARSE_SYSTEM_PROMPT},
+            {"role": "user", "content": _PARSE_USER_PROMPT + raw_text}
         ],
         max_tokens=1500,
-        temperature=0.1
+        temperature=0.1,
+        response_format={"type": "json_object"}
     )
     
-    # Parse response
-    result = response.choices[0].message.content
-    # Remove markdown code blocks if present
-    if result.startswith("```"):
-        result = result.split("```json")[1].split("```")[0].strip() if "```json" in result else result.split("```")[1].split("```")[0].strip()
+    return response.choices[0].message.content
+
+def check_ocr_confidence(ocr_confidence):
+    """Raise ValueError when OCR confidence is too low for reliable parsing"""
+    if ocr_confidence < MIN_OCR_CONFIDENCE:
+        raise ValueError(f"OCR confidence too low ({ocr_confidence:.0%}). Image quality insufficient for reliable parsing. Minimum required: {MIN_OCR_CONFIDENCE:.0%}")
+
+def check_receipt_text(raw_text):
+    """Raise ValueError when OCR text is too short or has too few digits to be a receipt"""
+    if len(raw_text) < MIN_RECEIPT_TEXT_LENGTH:
+        raise ValueError(f"Receipt text too short ({len(raw_text)} characters, minimum {MIN_RECEIPT_TEXT_LENGTH}). Image does not appear to be a readable receipt")
+    digits = sum(map(str.isdigit, raw_text))
+    if digits < MIN_RECEIPT_DIGITS:
+        raise ValueError(f"Receipt text contains too few digits ({digits}, minimum {MIN_RECEIPT_DIGITS}) to include any prices")
+
+def parse_receipt_text_with_ai(raw_text):
+    """Parse OCR text into structured receipt data with Groq"""
+    # Skip the AI call for text that can't be a receipt
+    check_receipt_text(raw_text)
+    
+    # Use Groq to parse the OCR text (cached for identical OCR text)
+    result = groq_parse_receipt_text(raw_text)
     
-    parsed_data = json.loads(result)
+    parsed_data = orjson.loads(result)
     
     # Check if AI detected unreadable content
     if 'error' in parsed_data and parsed_data['error'] == 'unreadable':
@@ -146,63 +431,70 @@ Text:
     
     # Ensure all items have a category
     for item in parsed_data.get('items', []):
-        if 'category' not in item or item['category'] not in CATEGORIES:
-            item['category'] = 'Uncategorized'
+        item['category'] = normalize_category(item.get('category'))
     
-    # Add the raw OCR text, confidence, and bounding boxes
+    return parsed_data
+
+def attach_ocr_fields(parsed_data, raw_text, ocr_confidence, ocr_data):
+    """Add the raw OCR text, confidence, and bounding boxes to an AI parse result"""
     parsed_data['raw_text'] = raw_text
     parsed_data['ocr_confidence'] = ocr_confidence
     parsed_data['ocr_data'] = ocr_data
-    
     return parsed_data
 
-@app.route("/api/health", methods=["GET"])
-def health():
-    return jsonify({"status": "ok"})
-
-def categorize_items_with_ai(items):
-    """Use AI to categorize extracted items"""
-    if not items:
-        return items
+def parse_receipt_with_ai(image_bytes):
+    """Parse receipt using OCR + OpenAI text parsing"""
+    # Step 1: OCR the image to get raw text, confidence, and bounding boxes
+    raw_text, ocr_confidence, ocr_data = run_ocr(image_bytes)
     
-    # Build category list for the prompt
-    category_list = ", ".join(CATEGORIES)
+    # Check if OCR confidence is too low
+    check_ocr_confidence(ocr_confidence)
     
-    # Prepare items for AI
-    items_text = "\n".join([f"{i+1}. {item['description']}" for i, item in enumerate(items)])
+    # Step 2: Use Groq to parse the OCR text
+    parsed_data = parse_receipt_text_with_ai(raw_text)
     
+    return attach_ocr_fields(parsed_data, raw_text, ocr_confidence, ocr_data)
+
+@app.errorhandler(413)
+def upload_too_large(error):
+    return json_response({"error": f"File too large. Maximum upload size is {MAX_UPLOAD_MB} MB"}, 413)
+
+@app.route("/api/health", methods=["GET"])
+def health():
+    return json_response({"status": "ok"})
+
+@lru_cache(maxsize=GROQ_CACHE_SIZE)
+def groq_categorize_items_text(items_text):
+    """Ask Groq to categorize a numbered item list and return the raw reply"""
     response = groq_client.chat.completions.create(
         model=GROQ_MODEL,
         messages=[
-            {
-                "role": "system",
-                "content": f"""You are a receipt item categorizer. Categorize each item into one of these categories: {category_list}
-
-Return ONLY a JSON array with category names in the same order as the input items. Example: ["Groceries", "Dining", "Transport"]"""
-            },
-            {
-                "role": "user",
-                "content": f"""Categorize these items:
-{items_text}"""
-            }
+            {"role": "system", "content": _CATEGORIZE_SYSTEM_PROMPT},
+            {"role": "user", "content": _CATEGORIZE_USER_PROMPT + items_text}
         ],
         max_tokens=500,
-        temperature=0.1
+        temperature=0.1,
+        response_format={"type": "json_object"}
     )
     
-    # Parse response
-    result = response.choices[0].message.content.strip()
-    # Remove markdown code blocks if present
-    if result.startswith("```"):
-        result = result.split("```json")[1].split("```")[0].strip() if "```json" in result else result.split("```")[1].split("```")[0].strip()
+    return response.choices[0].message.content
+
+def categorize_items_with_ai(items):
+    """Use AI to categorize extracted items"""
+    if not items:
+        return items
+    
+    # Prepare items for AI
+    items_text = "\n".join([f"{i+1}. {item['description']}" for i, item in enumerate(items)])
     
-    categories = json.loads(result)
+    # Identical item lists reuse the cached Groq reply
+    result = groq_categorize_items_text(items_text)
+    categories = orjson.loads(result).get('categories', [])
     
     # Assign categories to items
     for i, item in enumerate(items):
         if i < len(categories):
-            category = categories[i]
-            item['category'] = category if category in CATEGORIES else 'Uncategorized'
+            item['category'] = normalize_category(categories[i])
         else:
             item['category'] = 'Uncategorized'
     
@@ -211,100 +503,97 @@ Return ONLY a JSON array with category names in the same order as the input item
 @app.route("/api/scan", methods=["POST"])
 def scan_receipt():
     if 'file' not in request.files:
-        return jsonify({"error": "No file uploaded"}), 400
+        return json_response({"error": "No file uploaded"}, 400)
 
     file = request.files['file']
     if file.filename == '':
-        return jsonify({"error": "No file selected"}), 400
+        return json_response({"error": "No file selected"}, 400)
 
     try:
-        image = Image.open(file.stream)
+        image_bytes = file.stream.read()
+        if not has_image_signature(image_bytes):
+            return json_response({"error": "Uploaded file is not a supported image"}, 400)
         
         # Perform OCR with PaddleOCR to get text, confidence, and bounding boxes
-        raw_text, ocr_confidence, ocr_data = perform_ocr_with_paddleocr(image)
+        raw_text, ocr_confidence, ocr_data = run_ocr(image_bytes)
 
-        # Parse structured fields from raw_text
-        lines = raw_text.splitlines()
-        store = lines[0] if lines else "Unknown Store"
+        # Normalize every line boundary splitlines() knows (\r, \r\n, \v, \u2028, ...) to \n
+        scan_text = '\n'.join(raw_text.splitlines())
+        
+        # Parse structured fields from raw_text (store is the first line)
+        store = scan_text.partition('\n')[0].strip() or "Unknown Store"
         date = ""
         total = 0.0
         tax = 0.0
         items = []
 
-        # Extract items using regex patterns
-        for line in lines:
-            line_stripped = line.strip()
-            
-            # Skip empty lines
-            if not line_stripped:
-                continue
+        # Extract totals, date, and items in a single regex scan
+        for match in _SCAN_RE.finditer(scan_text):
+            kind = match.lastgroup
             
             # Check for total/subtotal
-            if "subtotal" in line.lower() or "total" in line.lower():
-                try:
-                    numbers = re.findall(r'\d+\.\d{2}', line)
-                    if numbers:
-                        total = float(numbers[-1])
-                except ValueError:
-                    pass
+            if kind == 'total':
+                numbers = _PRICE_RE.findall(match.group('total'))
+                if numbers:
+                    total = float(numbers[-1])
             # Check for tax
-            elif "tax" in line.lower():
-                try:
-                    numbers = re.findall(r'\d+\.\d{2}', line)
-                    if numbers:
-                        tax = float(numbers[-1])
-                except ValueError:
-                    pass
+            elif kind == 'tax':
+                numbers = _PRICE_RE.findall(match.group('tax'))
+                if numbers:
+                    tax = float(numbers[-1])
             # Check for date
-            elif re.search(r'\d{1,2}[/-]\d{1,2}[/-]\d{2,4}', line):
-                date = line_stripped
-            # Try to extract items (lines with prices)
+            elif kind == 'date':
+                date = match.group('date').strip()
+            # Lines with prices (e.g., "Milk $4.99" or "Bread 3.50")
             else:
-                # Pattern: description followed by price (e.g., "Milk $4.99" or "Bread 3.50")
-                price_match = re.search(r'(.*?)\s*[\$]?\s*(\d+[.,]\d{2})$', line_stripped)
-                if price_match:
-                    description = price_match.group(1).strip()
-                    price_str = price_match.group(2).replace(',', '.')
+                description = match.group('description').strip()
+                price_str = match.group('price').replace(',', '.')
+                
+                # Filter out lines that are likely totals/subtotals
+                if description and not _KEYWORD_RE.search(description):
+                    item_price = float(price_str)
                     
-                    # Filter out lines that are likely totals/subtotals
-                    if description and not any(word in description.lower() for word in ['total', 'subtotal', 'tax', 'balance', 'change', 'cash', 'card']):
-                        try:
-                            item_price = float(price_str)
-                            
-                            # Check for quantity pattern (e.g., "2 x Milk" or "2x Milk")
-                            qty_match = re.match(r'(\d+)\s*x\s*(.*)', description, re.IGNORECASE)
-                            if qty_match:
-                                quantity = int(qty_match.group(1))
-                                description = qty_match.group(2).strip()
-                                unit_price = round(item_price / quantity, 2)
-                            else:
-                                quantity = 1
-                                unit_price = item_price
-                            
-                            items.append({
-                                'description': description,
-                                'quantity': quantity,
-                                'unitPrice': unit_price,
-                                'total': item_price
-                            })
-                        except ValueError:
-                            pass
-
-        # Use AI to categorize items only if items were found
-        if items and AI_PARSING_ENABLED:
+                    # Check for quantity pattern (e.g., "2 x Milk" or "2x Milk")
+                    qty_match = _QTY_RE.match(description)
+                    if qty_match:
+                        quantity = int(qty_match.group(1))
+                        description = qty_match.group(2).strip()
+                        unit_price = round(item_price / quantity, 2)
+                    else:
+                        quantity = 1
+                        unit_price = item_price
+                    
+                    items.append({
+                        'description': description,
+                        'quantity': quantity,
+                        'unitPrice': unit_price,
+                        'total': item_price
+                    })
+
+        # Categorize items from known keywords; only the rest need the AI
+        uncategorized = []
+        for item in items:
+            category = classify_item(item['description'])
+            if category:
+                item['category'] = category
+            else:
+                uncategorized.append(item)
+
+        # Use AI to categorize remaining items only if any are left
+        if uncategorized and AI_PARSING_ENABLED:
             try:
-                items = categorize_items_with_ai(items)
+                categorize_items_with_ai(uncategorized)
             except Exception as e:
                 print(f"AI categorization failed: {str(e)}")
-                # If AI fails, set all to Uncategorized
-                for item in items:
+                # If AI fails, set remaining items to Uncategorized
+                for item in uncategorized:
                     item['category'] = 'Uncategorized'
-        elif items:
-            # No AI available, set all to Uncategorized
-            for item in items:
+        else:
+            # No AI available, set remaining items to Uncategorized
+            for item in uncategorized:
                 item['category'] = 'Uncategorized'
 
-        return jsonify({
+        return json_response({
             "message": "Scan successful",
             "raw_text": raw_text,
             "store": store,
@@ -316,60 +605,128 @@ def scan_receipt():
             "ocr_data": ocr_data
         })
 
+    except Image.DecompressionBombError:
+        return json_response({"error": IMAGE_TOO_LARGE_ERROR}, 413)
     except Exception as e:
-        return jsonify({"error": str(e)}), 500
+        return json_response({"error": str(e)}, 500)
 
-@app.route("/api/scan-ai", methods=["POST"])
-def scan_receipt_ai():
-    """AI-powered receipt parsing using OpenAI Vision API"""
+def validate_ai_upload():
+    """Return an error response if the AI endpoints can't accept this upload, else None"""
     if not AI_PARSING_ENABLED:
-        return jsonify({"error": "AI parsing is disabled"}), 503
+        return json_response({"error": "AI parsing is disabled"}, 503)
     
     if 'file' not in request.files:
-        return jsonify({'error': 'No file provided'}), 400
+        return json_response({'error': 'No file provided'}, 400)
     
     file = request.files['file']
     
     if file.filename == '':
-        return jsonify({'error': 'No file selected'}), 400
+        return json_response({'error': 'No file selected'}, 400)
     
     # Validate file type
-    allowed_extensions = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
-    file_ext = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else ''
-    if file_ext not in allowed_extensions:
-        return jsonify({'error': f'Invalid file type. Allowed: {", ".join(allowed_extensions)}'}), 400
+    file_ext = os.path.splitext(file.filename)[1].lower()
+    if file_ext not in ALLOWED_EXTENSIONS:
+        return json_response({'error': INVALID_FILE_TYPE_ERROR}, 400)
+    
+    return None
+
+def finalize_ai_result(parsed_data):
+    """Add the confidence and item IDs the frontend expects to an AI parse result"""
+    # Use OCR confidence directly
+    parsed_data['confidence'] = parsed_data.get('ocr_confidence', 0.7)
+    
+    # Generate unique IDs for items if not present
+    for i, item in enumerate(parsed_data.get('items', [])):
+        if 'id' not in item:
+            item['id'] = f"item-{i+1}"
+    
+    return parsed_data
+
+def unparseable_receipt_error(error):
+    """Error body for low confidence or unreadable receipts"""
+    return {
+        'error': 'Unable to parse receipt',
+        'reason': str(error),
+        'suggestion': 'Please upload a clearer image with better lighting and focus'
+    }
+
+def sse_event(event, payload):
+    """Format one Server-Sent Event with a JSON payload"""
+    return b"event: " + event.encode() + b"\ndata: " + orjson.dumps(payload) + b"\n\n"
+
+@app.route("/api/scan-ai", methods=["POST"])
+def scan_receipt_ai():
+    """AI-powered receipt parsing using OpenAI Vision API"""
+    error_response = validate_ai_upload()
+    if error_response:
+        return error_response
     
     try:
-        # Open image directly from upload stream (same as regex endpoint)
-        image = Image.open(file.stream)
-        
-        # Parse with OpenAI (passing image directly, no disk I/O)
-        parsed_data = parse_receipt_with_ai(image)
+        # Read the upload once; decoding happens in the OCR worker (same as regex endpoint)
+        image_bytes = request.files['file'].stream.read()
+        if not has_image_signature(image_bytes):
+            return json_response({'error': 'Uploaded file is not a supported image'}, 400)
         
-        # Use OCR confidence directly
-        parsed_data['confidence'] = parsed_data.get('ocr_confidence', 0.7)
+        # Parse with OpenAI (passing image bytes directly, no disk I/O)
+        parsed_data = finalize_ai_result(parse_receipt_with_ai(image_bytes))
         
-        # Generate unique IDs for items if not present
-        for i, item in enumerate(parsed_data.get('items', [])):
-            if 'id' not in item:
-                item['id'] = f"item-{i+1}"
-        
-        return jsonify(parsed_data), 200
+        return json_response(parsed_data, 200)
+    
+    except Image.DecompressionBombError:
+        return json_response({'error': IMAGE_TOO_LARGE_ERROR}, 413)
     
     except ValueError as e:
         # Handle low confidence or unreadable content
-        error_msg = str(e)
-        return jsonify({
-            'error': 'Unable to parse receipt',
-            'reason': error_msg,
-            'suggestion': 'Please upload a clearer image with better lighting and focus'
-        }), 400
+        return json_response(unparseable_receipt_error(e), 400)
         
-    except json.JSONDecodeError as e:
-        return jsonify({'error': f'Invalid JSON response from AI: {str(e)}'}), 500
+    except orjson.JSONDecodeError as e:
+        return json_response({'error': f'Invalid JSON response from AI: {str(e)}'}, 500)
     except Exception as e:
         print(f"Error in AI parsing: {str(e)}")
-        return jsonify({'error': f'AI parsing failed: {str(e)}'}), 500
+        return json_response({'error': f'AI parsing failed: {str(e)}'}, 500)
 
-if __name__ == "__main__":
-    app.run(debug=True, port=5000)
+@app.route("/api/scan-ai/stream", methods=["POST"])
+def scan_receipt_ai_stream():
+    """AI-powered receipt parsing streamed as Server-Sent Events.
+    
+    Sends an "ocr" event as soon as OCR finishes (raw text, confidence, bounding
+    boxes), then a "result" event with the same body as /api/scan-ai, or an
+    "error" event with the same body as its error responses.
+    """
+    error_response = validate_ai_upload()
+    if error_response:
+        return error_response
+    
+    image_bytes = request.files['file'].stream.read()
+    if not has_image_signature(image_bytes):
+        return json_response({'error': 'Uploaded file is not a supported image'}, 400)
+    
+    def generate():
+        try:
+            raw_text, ocr_confidence, ocr_data = run_ocr(image_bytes)
+            yield sse_event('ocr', {
+                'raw_text': raw_text,
+                'confidence': ocr_confidence,
+                'ocr_data': ocr_data
+            })
+            
+            check_ocr_confidence(ocr_confidence)
+            parsed_data = attach_ocr_fields(
+                parse_receipt_text_with_ai(raw_text), raw_text, ocr_confidence, ocr_data
+            )
+            
+            yield sse_event('result', finalize_ai_result(parsed_data))
+        
+        except Image.DecompressionBombError:
+            yield sse_event('error', {'error': IMAGE_TOO_LARGE_ERROR})
+        except ValueError as e:
+            yield sse_event('error', unparseable_receipt_error(e))
+        except Exception as e:
+            print(f"Error in AI parsing: {str(e)}")
+            yield sse_event('error', {'error': f'AI parsing failed: {str(e)}'})
+    
+    return app.response_class(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}
+    )
@@ -0,0 +1,9 @@
+"""WSGI entry point.
+
+Production: gunicorn -w $(nproc) -k gthread --threads 2 -t 120 wsgi:app
+Development: python wsgi.py
+"""
+from app import app
+
+if __name__ == "__main__":
+    app.run(debug=True, port=5000)